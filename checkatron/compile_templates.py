@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Ahead-of-time compile the Jinja2 templates to plain Python modules.
+
+Run once at package-build time (or manually in a checkout):
+
+    python -m checkatron.compile_templates
+
+This writes compiled modules into ``checkatron/_compiled_templates``; at
+runtime ``diffgen`` loads them via ModuleLoader, replacing the template
+lex/parse/compile pass with a normal Python import.  If the directory is
+missing, ``diffgen`` falls back to the .j2 sources, so this step is optional
+for development.
+"""
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader
+
+from .diffgen import _COMPILED_DIR, _ENV_OPTIONS, _TEMPLATE_DIR
+
+
+def compile_templates(target: Path = _COMPILED_DIR) -> Path:
+    """Compile every template under checkatron/templates into `target`."""
+    env = Environment(loader=FileSystemLoader(_TEMPLATE_DIR), **_ENV_OPTIONS)
+    env.compile_templates(target=str(target), zip=None)
+    return target
+
+
+if __name__ == "__main__":
+    out = compile_templates()
+    print(f"Compiled templates written to {out}")
@@ -20,31 +20,141 @@ $ python diffgen.py \
 """
 import argparse
 import csv
+import mmap
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterator, List, Dict, Tuple
+
+from jinja2 import Environment, FileSystemLoader, ModuleLoader
+
+# Lift the per-field size cap so the C csv reader never has to police
+# unusually long type/default strings.
+csv.field_size_limit(sys.maxsize)
+
+_TEMPLATE_DIR = Path(__file__).parent / "templates"
+_COMPILED_DIR = Path(__file__).parent / "_compiled_templates"
+
+# Shared between the runtime Environment and the AOT compiler in
+# checkatron.compile_templates so compiled templates match runtime settings.
+# autoescape stays off: it would apply HTML escaping (wrong for SQL) and
+# push every substitution through a MarkupSafe scan.
+_ENV_OPTIONS = dict(
+    autoescape=False,
+    auto_reload=False,
+    cache_size=50,
+    optimized=True,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    keep_trailing_newline=False,
+)
+
+
+def _make_environment() -> Environment:
+    """
+    Build the Environment once at import time: Jinja compiles templates to
+    Python bytecode and caches them per Environment, so reusing it makes every
+    build_sql call after the first a cache lookup plus render.  auto_reload is
+    off so renders skip the template mtime stat.
+
+    If the templates were compiled ahead of time (see
+    ``python -m checkatron.compile_templates``), load them via ModuleLoader,
+    which skips the lex/parse/compile pass entirely; otherwise fall back to
+    reading the .j2 sources (dev mode).
+    """
+    if _COMPILED_DIR.is_dir():
+        loader = ModuleLoader(_COMPILED_DIR)
+    else:
+        loader = FileSystemLoader(_TEMPLATE_DIR)
+    return Environment(loader=loader, **_ENV_OPTIONS)
+
+
+_ENV = _make_environment()
+_TPL = _ENV.get_template("full_compare.sql.j2")
+# Specialization for the dominant "same table, two dates" invocation where
+# the before/after column lists are identical.
+_TPL_SAME = _ENV.get_template("full_compare_same.sql.j2")
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 # ------------------------------------------------------------------ helpers
-def load_schema(csv_path: Path) -> List[Dict[str, str]]:
-    """Read the output of Snowflake's 'DESCRIBE TABLE ...' CSV."""
-    with csv_path.open(newline='') as f:
-        reader = csv.DictReader(f)
-        return [row for row in reader]
+# Below this size the mmap setup costs more than it saves.
+_MMAP_MIN_SIZE = 64 * 1024
+
+
+def _load_schema_mmap(csv_path: Path) -> "List[Tuple[str, str]] | None":
+    """
+    Byte-level fast path for large schema CSVs: memory-map the file, scan
+    for line ends with mm.find, and decode only the two fields we keep.
+    Avoids the csv module's per-line str objects entirely.
+
+    Returns None if the file uses quoting (e.g. "NUMBER(38,0)"), which the
+    naive comma split cannot handle – the caller falls back to csv.reader.
+    """
+    with open(csv_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm.find(b'"') != -1:
+                return None
+            size = len(mm)
+            end = mm.find(b"\n")
+            if end == -1:
+                end = size
+            header = mm[:end].rstrip(b"\r").split(b",")
+            i_name = header.index(b"name")
+            i_type = header.index(b"type")
+            rows: List[Tuple[str, str]] = []
+            off = end + 1
+            while off < size:
+                end = mm.find(b"\n", off)
+                if end == -1:
+                    end = size
+                line = mm[off:end].rstrip(b"\r")
+                if line:
+                    fields = line.split(b",")
+                    rows.append((fields[i_name].decode("utf-8"),
+                                 fields[i_type].decode("utf-8")))
+                off = end + 1
+            return rows
+        finally:
+            mm.close()
 
 
-def infer_sql_type(col: Dict[str, str]) -> str:
+def load_schema(csv_path: Path) -> List[Tuple[str, str]]:
+    """
+    Read the output of Snowflake's 'DESCRIBE TABLE ...' CSV.
+
+    Only the 'name' and 'type' columns are ever consumed downstream, so
+    return (name, type) tuples rather than a dict per row – DictReader's
+    per-row header zipping dominates parse time on wide DESCRIBE output.
+    """
+    if csv_path.stat().st_size > _MMAP_MIN_SIZE:
+        rows = _load_schema_mmap(csv_path)
+        if rows is not None:
+            return rows
+    with csv_path.open("r", newline="", buffering=1 << 16, encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i_name = header.index("name")
+        i_type = header.index("type")
+        return [(row[i_name], row[i_type]) for row in reader]
+
+
+# Snowflake type keywords, keyed by the token before any '(precision)' part.
+_TEXT_TYPES = frozenset({"VARCHAR", "STRING", "TEXT", "CHAR"})
+_NUMBER_TYPES = frozenset({
+    "NUMBER", "INT", "INTEGER", "BIGINT", "SMALLINT", "TINYINT",
+    "FLOAT", "DOUBLE", "DECIMAL", "NUMERIC",
+})
+
+
+def infer_sql_type(col: Tuple[str, str]) -> str:
     """
     Very small helper – just returns 'TEXT' or 'NUMBER'.
     We only need this for quoting literals correctly.
     """
-    t = col["type"].upper()
-    if "VARCHAR" in t or "STRING" in t or "TEXT" in t:
-        return "TEXT"
-    if "NUMBER" in t or "INT" in t or "FLOAT" in t or "DECIMAL" in t:
-        return "NUMBER"
-    return "TEXT"  # fallback
+    head = col[1].upper().split("(", 1)[0].strip()
+    return "NUMBER" if head in _NUMBER_TYPES else "TEXT"  # TEXT is the fallback
 
 
 def parse_args(argv: List[str]) -> argparse.Namespace:
@@ -58,86 +168,272 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     p.add_argument("--before_table", help="Override DB.SCHEMA.TABLE (before)")
     p.add_argument("--after_table",  help="Override DB.SCHEMA.TABLE (after)")
     p.add_argument("--out", type=Path, default=Path("diff.sql"),
-                   help="Output SQL file")
+                   help="Output SQL file ('-' writes to stdout for piping)")
     p.add_argument("--single_line", action="store_true",
                    help="Emit SQL as a single line (remove -- comments; collapse whitespace)")
+    p.add_argument("--use_jinja", action="store_true",
+                   help="Render via the Jinja template instead of the built-in codegen "
+                        "(for users customizing full_compare.sql.j2)")
     p.add_argument("--stack_input", type=Path,
                    help="If set, prepend the single-line SQL to this stack file (one statement per line)")
     return p.parse_args(argv)
 
 
+def _table_name(csv_path: Path, override: "str | None") -> str:
+    """Infer DB.SCHEMA.TABLE from the file name unless overridden."""
+    # strip .csv and replace _ with .
+    return override if override else csv_path.stem.replace("_", ".")
+
+
 # ------------------------------------------------------------------ main
-def build_sql(args: argparse.Namespace) -> str:
-    before_cols = load_schema(args.before_csv)
-    after_cols  = load_schema(args.after_csv)
-    key_cols    = [row["name"].upper() for row in load_schema(args.keys)]
-
-    # Build union list of all columns, preserve order encountered
-    before_names = [c["name"].upper() for c in before_cols]
-    after_names = [c["name"].upper() for c in after_cols]
-    all_names = before_names + \
-                [c["name"].upper() for c in after_cols
-                 if c["name"].upper() not in {c2["name"].upper() for c2 in before_cols}]
+def _template_context(args: argparse.Namespace) -> Dict[str, object]:
+    # The three schema files are independent reads; overlap their I/O so
+    # the load step costs one file latency instead of three (matters most
+    # on network filesystems).
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        fb = ex.submit(load_schema, args.before_csv)
+        fa = ex.submit(load_schema, args.after_csv)
+        fk = ex.submit(load_schema, args.keys)
+        before_cols = fb.result()
+        after_cols  = fa.result()
+        key_cols    = [name.upper() for name, _ in fk.result()]
+
+    # Normalize each schema in a single pass: uppercase every column name
+    # exactly once and infer its type alongside, then reuse the lists.
+    before_names: List[str] = []
+    before_types: List[str] = []
+    for c in before_cols:
+        before_names.append(c[0].upper())
+        before_types.append(infer_sql_type(c))
+    after_names: List[str] = []
+    after_types: List[str] = []
+    for c in after_cols:
+        after_names.append(c[0].upper())
+        after_types.append(infer_sql_type(c))
+
+    # Build union list of all columns, preserve order encountered.  The
+    # common "same table, two dates" case has identical lists, so skip the
+    # dedup entirely when they match.
+    if before_names == after_names:
+        all_names = before_names
+    else:
+        before_upper = set(before_names)
+        all_names = before_names + [n for n in after_names if n not in before_upper]
     # Build lookup of type
-    type_map: Dict[str, str] = {c["name"].upper(): infer_sql_type(c)
-                                for c in before_cols + after_cols}
-
-    # Infer table names from file names if not overridden
-    def table_name(csv_path: Path, override: str | None) -> str:
-        if override:
-            return override
-        # strip .csv and replace _ with .
-        stem = csv_path.stem.replace("_", ".")
-        return stem
-
-    before_table = table_name(args.before_csv, args.before_table)
-    after_table  = table_name(args.after_csv,  args.after_table)
-
-    j2 = Environment(
-        loader=FileSystemLoader(Path(__file__).parent / "templates"),
-        autoescape=select_autoescape(["sql.j2"])
-    )
-    tpl = j2.get_template("full_compare.sql.j2")
-    return tpl.render(
+    type_map: Dict[str, str] = dict(zip(before_names, before_types))
+    type_map.update(zip(after_names, after_types))
+
+    before_table = _table_name(args.before_csv, args.before_table)
+    after_table  = _table_name(args.after_csv,  args.after_table)
+
+    # key_cols/all_cols are iterated in order; before_cols/after_cols are
+    # only membership-tested in the template, so pass frozensets to make
+    # each 'col in before_cols' check O(1) instead of O(N).
+    return dict(
         before_table=before_table,
         after_table=after_table,
-        key_cols=key_cols,
-        all_cols=all_names,
-        before_cols=before_names,
-        after_cols=after_names,
+        key_cols=tuple(key_cols),
+        all_cols=tuple(all_names),
+        before_cols=frozenset(before_names),
+        after_cols=frozenset(after_names),
         type_map=type_map,
         before_where=args.before_where,
         after_where=args.after_where,
     )
 
 
+_SQL_HEADER = """\
+/*
+  diff table created by diffgen.py
+  0 = match
+  1 = both non-null but different
+  2 = null in BEFORE only
+  3 = null in AFTER  only
+  4 = row missing in BEFORE
+  5 = row missing in AFTER
+*/
+CREATE OR REPLACE TABLE diff_result AS
+WITH
+"""
+
+
+# Bounded: build_sql is library API, so a long-lived caller diffing many
+# distinct schemas must not accumulate an arm per column name forever.
+@lru_cache(maxsize=4096)
+def _case_arm(col: str) -> str:
+    """
+    Per-column status CASE arm, shared by the codegen and the template (as
+    the 'arm' global).  Memoized so batch runs over the same schema build
+    each fragment once; the arm depends only on the column name, so the
+    name is the whole cache key.
+    """
+    return (
+        f"    CASE\n"
+        f"        WHEN b_{col} IS NULL AND a_{col} IS NULL THEN 0\n"
+        f"        WHEN b_{col} IS NULL AND a_{col} IS NOT NULL THEN 2\n"
+        f"        WHEN b_{col} IS NOT NULL AND a_{col} IS NULL THEN 3\n"
+        f"        WHEN b_{col} = a_{col} THEN 0\n"
+        f"        ELSE 1\n"
+        f"    END AS {col}"
+    )
+
+
+_ENV.globals["arm"] = _case_arm
+
+
+def _render_sql_parts(before_table: str, after_table: str, key_cols, all_cols,
+                      before_cols, after_cols, type_map: Dict[str, str],
+                      before_where: str, after_where: str) -> Iterator[str]:
+    """
+    Hand-written codegen for the diff SQL – the hot default path.
+
+    The output has a fixed shape (preamble + one CASE arm per column), so
+    plain f-strings and str.join beat Jinja's generic node loop by a wide
+    margin on wide schemas.  Yields text chunks so callers can stream or
+    join; the template path stays available behind --use_jinja for anyone
+    customizing full_compare.sql.j2.
+    """
+    key_list = ",\n    ".join(key_cols)
+    join_sel = [f"k.{k} AS K_{k}" for k in key_cols]
+    if before_cols == after_cols:
+        # Same-schema specialization: every column exists on both sides, so
+        # no membership checks or NULL padding are needed.
+        join_sel += [f"b.{c} AS b_{c}" for c in all_cols]
+        join_sel += [f"a.{c} AS a_{c}" for c in all_cols]
+    else:
+        join_sel += [f"b.{c} AS b_{c}" if c in before_cols else f"NULL AS b_{c}"
+                     for c in all_cols]
+        join_sel += [f"a.{c} AS a_{c}" if c in after_cols else f"NULL AS a_{c}"
+                     for c in all_cols]
+    on_before = "\n      AND ".join(
+        f"(b.{k} IS NULL AND k.{k} IS NULL OR b.{k} = k.{k})" for k in key_cols)
+    on_after = "\n      AND ".join(
+        f"(a.{k} IS NULL AND k.{k} IS NULL OR a.{k} = k.{k})" for k in key_cols)
+    arms = [_case_arm(c) for c in all_cols]
+    k0 = key_cols[0]
+    yield _SQL_HEADER
+    yield ("before_filt AS (\n    SELECT * FROM " + before_table
+           + (f"\n    WHERE {before_where}" if before_where else "")
+           + "\n),\n")
+    yield ("after_filt AS (\n    SELECT * FROM " + after_table
+           + (f"\n    WHERE {after_where}" if after_where else "")
+           + "\n),\n")
+    yield "/* all keys combinations that exist in either side */\n"
+    yield ("all_keys AS (\n    SELECT\n    " + key_list
+           + "\n    FROM before_filt\n    UNION\n    SELECT\n    " + key_list
+           + "\n    FROM after_filt\n),\n")
+    yield ("joined AS (\n    SELECT\n        " + ",\n        ".join(join_sel)
+           + "\n    FROM all_keys k"
+           + "\n    LEFT JOIN before_filt b\n      ON " + on_before
+           + "\n    LEFT JOIN after_filt a\n      ON " + on_after
+           + "\n)\n")
+    yield ("SELECT\n    CASE\n"
+           f"        WHEN b_{k0} IS NULL THEN 4\n"
+           f"        WHEN a_{k0} IS NULL THEN 5\n"
+           "        ELSE NULL\n    END AS _row_status,\n")
+    yield "".join(f"    K_{k},\n" for k in key_cols)
+    yield ",\n".join(arms)
+    yield "\nFROM joined;"
+
+
+def build_sql_stream(args: argparse.Namespace):
+    """
+    Render the diff SQL incrementally as a Jinja TemplateStream.
+
+    Streaming keeps peak memory at one buffer instead of the whole rendered
+    SQL (O(columns x CASE arms) bytes) and lets write I/O overlap rendering;
+    use .dump(path) to write straight to a file.
+    """
+    ctx = _template_context(args)
+    tpl = _TPL_SAME if ctx["before_cols"] == ctx["after_cols"] else _TPL
+    stream = tpl.stream(**ctx)
+    stream.enable_buffering(size=5)
+    return stream
+
+
+def _iter_lines(chunks) -> Iterator[str]:
+    """Re-chunk an iterable of text fragments into newline-terminated lines."""
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        if "\n" in buf:
+            lines = buf.split("\n")
+            buf = lines.pop()
+            for line in lines:
+                yield line + "\n"
+    if buf:
+        yield buf
+
+
+def build_sql_lines(args: argparse.Namespace) -> Iterator[str]:
+    """
+    Yield the diff SQL line by line without materializing the whole script.
+
+    Lets callers preview a prefix (itertools.islice) or writelines to a
+    file while holding only one line in memory.
+    """
+    if getattr(args, "use_jinja", False):
+        chunks = build_sql_stream(args)
+    else:
+        chunks = _render_sql_parts(**_template_context(args))
+    return _iter_lines(chunks)
+
+
+def build_sql(args: argparse.Namespace) -> str:
+    if getattr(args, "use_jinja", False):
+        return "".join(build_sql_stream(args))
+    return "".join(_render_sql_parts(**_template_context(args)))
+
+
 def main():
     """Main entry point for the console script."""
     ns = parse_args(sys.argv[1:])
-    sql = build_sql(ns)
 
-    # Optionally convert to single line for batching
-    single = sql
+    # '--out -' streams to stdout so batch pipelines can pipe the SQL
+    # onwards without an intermediate file; status messages move to stderr
+    # to keep the pipe clean.
+    to_stdout = str(ns.out) == "-"
+
+    single = ""
     if ns.single_line:
+        # Single-line mode needs the whole text in memory anyway.
+        sql = build_sql(ns)
         # Drop lines starting with -- and collapse all whitespace to single spaces
         lines = []
-        for line in single.splitlines():
+        for line in sql.splitlines():
             stripped = line.lstrip()
             if stripped.startswith("--"):
                 continue
             lines.append(line)
         single = " ".join(" ".join(lines).split())
+        if to_stdout:
+            sys.stdout.write(sql)
+        else:
+            ns.out.write_text(sql)
+    elif to_stdout:
+        sys.stdout.writelines(build_sql_lines(ns))
+    elif ns.use_jinja:
+        # Stream the template render straight into the file.
+        build_sql_stream(ns).dump(str(ns.out))
+    else:
+        # Stream line-by-line so memory stays at one buffered chunk even
+        # for very wide schemas.
+        with ns.out.open("w", encoding="utf-8") as f:
+            f.writelines(build_sql_lines(ns))
+    if to_stdout:
+        sys.stdout.flush()
+    else:
+        print(f"SQL written to {ns.out}")
 
-    # Write normal output file
-    ns.out.write_text(sql)
-    print(f"SQL written to {ns.out}")
-
-    # Optionally append to a stack file (one statement per line)
+    # Optionally append to a stack file (one statement per line).  Append
+    # mode keeps batch loops O(N) – existing contents are never re-read or
+    # rewritten – and the large buffer flushes the line in one write.
     if ns.stack_input and ns.single_line:
         stack_path = ns.stack_input
-        with stack_path.open("a", encoding="utf-8") as f:
+        with stack_path.open("a", buffering=1 << 20, encoding="utf-8") as f:
             f.write(single.rstrip() + "\n")
-        print(f"Appended single-line SQL to {stack_path}")
+        print(f"Appended single-line SQL to {stack_path}",
+              file=sys.stderr if to_stdout else sys.stdout)
 
 
 if __name__ == "__main__":
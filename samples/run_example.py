@@ -6,13 +6,14 @@ This script shows how to generate SQL diff scripts using the sample CSV files.
 Run this from the project root directory.
 """
 
+import itertools
 import sys
 from pathlib import Path
 
 # Add the project root to the path so we can import checkatron
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from checkatron import build_sql, parse_args
+from checkatron import build_sql_lines, parse_args
 
 
 def main():
@@ -37,12 +38,6 @@ def main():
     print(f"📝 Output SQL: {output_sql.name}")
     print()
     
-    # Check if sample files exist
-    if not all(f.exists() for f in [before_csv, after_csv, keys_csv]):
-        print("❌ Error: Sample files not found!")
-        print("Make sure you're running this from the project root directory.")
-        return
-    
     try:
         # Generate the SQL
         print("🔄 Generating SQL diff script...")
@@ -53,17 +48,18 @@ def main():
             "--out", str(output_sql)
         ])
         
-        sql = build_sql(args)
-        output_sql.write_text(sql)
-        
+        # Stream line-by-line so we never hold the whole script in memory
+        with output_sql.open("w", encoding="utf-8") as out:
+            out.writelines(build_sql_lines(args))
+
         print("✅ SQL generated successfully!")
         print(f"📄 Output written to: {output_sql}")
         print()
-        
-        # Show a preview of the generated SQL
+
+        # Show a preview of the generated SQL (fresh iterator, first 10 lines)
         print("📋 SQL Preview (first 10 lines):")
         print("-" * 40)
-        lines = sql.split('\n')[:10]
+        lines = [ln.rstrip("\n") for ln in itertools.islice(build_sql_lines(args), 10)]
         for i, line in enumerate(lines, 1):
             print(f"{i:2d}: {line}")
         print("...")
@@ -87,6 +83,11 @@ def main():
         print("4. Download the results as CSV")
         print("5. Filter in Excel on any column > 0 to see differences")
         
+    except FileNotFoundError as e:
+        # Let the open() inside load_schema double as the existence check –
+        # no upfront stat calls, and the error names the offending file.
+        print(f"❌ Missing file: {e.filename}")
+        print("Make sure you're running this from the project root directory.")
     except Exception as e:
         print(f"❌ Error: {e}")
         print("Make sure you have installed checkatron in development mode:")
@@ -6,6 +6,9 @@ setup(
     description="SQL diff generation tool for database table comparisons",
     author="Your Name",
     packages=find_packages(),
+    package_data={
+        "checkatron": ["templates/*.j2", "_compiled_templates/*.py"],
+    },
     install_requires=[
         "jinja2>=3.1",
         "pytest>=7.4",
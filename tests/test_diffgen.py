@@ -15,7 +15,10 @@ import subprocess
 
 def mk_csv(rows, tmp: Path, name: str) -> Path:
     p = tmp / name
-    p.write_text("\n".join(rows))
+    # Stream the rows instead of allocating a joined string that write_text
+    # would immediately re-encode.
+    with p.open("w", encoding="utf-8", newline="") as f:
+        f.writelines(r + "\n" for r in rows)
     return p
 
 
@@ -194,6 +197,62 @@ def test_multiple_key_columns():
         assert res == [(0, None)]
 
 
+def test_use_jinja_matches_codegen(tmp_path: Path):
+    """The codegen and --use_jinja template paths must diff identically."""
+    schema = [
+        "name,type,kind,null?",
+        "k1,NUMBER,,",
+        "val,VARCHAR,,",
+    ]
+    before_csv = mk_csv(schema, tmp_path, "before.csv")
+    after_csv  = mk_csv(schema, tmp_path, "after.csv")
+    keys_csv   = mk_csv(["name,type", "k1,NUMBER"], tmp_path, "keys.csv")
+
+    argv = [
+        str(before_csv),
+        str(after_csv),
+        "--keys", str(keys_csv),
+        "--before_table", "before_table",
+        "--after_table",  "after_table",
+    ]
+    results = []
+    for extra in ([], ["--use_jinja"]):
+        con = duckdb.connect(":memory:")
+        con.execute("CREATE TABLE before_table(k1 INT, val VARCHAR)")
+        con.execute("CREATE TABLE after_table(k1 INT, val VARCHAR)")
+        con.execute("INSERT INTO before_table VALUES (1,'a'), (2,'b')")
+        con.execute("INSERT INTO after_table  VALUES (1,'a'), (2,'c')")
+        con.execute(build_sql(parse_args(argv + extra)))
+        results.append(
+            con.execute("SELECT k_k1, val, _row_status FROM diff_result ORDER BY k_k1").fetchall())
+    assert results[0] == results[1] == [(1, 0, None), (2, 1, None)]
+
+
+def test_out_stdout(tmp_path: Path):
+    """--out - pipes the SQL to stdout with no status noise mixed in."""
+    schema = [
+        "name,type,kind,null?",
+        "k1,NUMBER,,",
+        "val,VARCHAR,,",
+    ]
+    before_csv = mk_csv(schema, tmp_path, "before.csv")
+    after_csv  = mk_csv(schema, tmp_path, "after.csv")
+    keys_csv   = mk_csv(["name,type", "k1,NUMBER"], tmp_path, "keys.csv")
+
+    cmd = [
+        sys.executable, "-m", "checkatron.diffgen",
+        str(before_csv), str(after_csv),
+        "--keys", str(keys_csv),
+        "--before_table", "B",
+        "--after_table", "A",
+        "--out", "-",
+    ]
+    r = subprocess.run(cmd, cwd=str(tmp_path), text=True, capture_output=True)
+    assert r.returncode == 0
+    assert "CREATE OR REPLACE TABLE diff_result AS" in r.stdout
+    assert "SQL written to" not in r.stdout
+
+
 def test_single_line_stack_prepend(tmp_path: Path):
     """Generate single-line SQL and prepend to a stack file for batching."""
     # minimal describe-like CSVs
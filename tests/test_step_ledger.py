@@ -0,0 +1,28 @@
+"""
+Unit tests for the step-ledger runner's subprocess helper.
+Simply run:  pytest
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "tools"))
+
+import step_ledger
+
+
+def test_run_kills_silently_hanging_child():
+    """A child that hangs holding its pipe open must hit the timeout."""
+    start = time.monotonic()
+    rc = step_ledger.run(
+        [sys.executable, "-c", "import time; time.sleep(60)"], timeout=2)
+    assert rc == 124
+    assert time.monotonic() - start < 30
+
+
+def test_run_captures_output():
+    """capture=True returns the child's stdout alongside the rc."""
+    rc, out = step_ledger.run(
+        [sys.executable, "-c", "print('hello')"], timeout=10, capture=True)
+    assert rc == 0
+    assert "hello" in out
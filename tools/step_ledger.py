@@ -20,132 +20,307 @@ Usage
 from __future__ import annotations
 
 import argparse
+import atexit
 import datetime as dt
+import functools
+import importlib.util
 import os
+import re
 import shutil
 import subprocess as sp
 import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Callable, List, Optional
+from typing import Callable, FrozenSet, Iterable, List, Optional
 
 ROOT = Path(__file__).resolve().parent.parent
 ART = ROOT / "artifacts"
 LEDGER = ART / "ledger"
 LOG = ART / "step_ledger.log"
 
+# Resolve the optional project venv interpreter once at import; resolve()
+# and exists() cost several syscalls each and were repeated per step.
+VENV_PY: Optional[Path] = (
+    (ROOT / "venv" / "bin" / "python")
+    if (ROOT / "venv" / "bin" / "python").exists() else None
+)
+PY_CMD = str(VENV_PY.resolve()) if VENV_PY else sys.executable
+
 
 def now() -> str:
     return dt.datetime.now().isoformat(timespec="seconds")
 
 
+def _fmt_ts(ns: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ns // 1_000_000_000))
+
+
+# Guards only the lazy open; the writes themselves need no lock because
+# os.write on an O_APPEND fd is atomic up to PIPE_BUF, so concurrent steps
+# interleave whole lines.
+_LOG_INIT_LOCK = threading.Lock()
+_LOG_FD: Optional[int] = None
+_STDOUT_FD = sys.stdout.fileno()
+
+
+def _get_log_fd() -> int:
+    """Open the log once as a raw append fd instead of per message."""
+    global _LOG_FD
+    if _LOG_FD is None:
+        with _LOG_INIT_LOCK:
+            if _LOG_FD is None:
+                ART.mkdir(parents=True, exist_ok=True)
+                _LOG_FD = os.open(str(LOG), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                atexit.register(os.close, _LOG_FD)
+    return _LOG_FD
+
+
+def log_at(ts_ns: int, msg: str) -> None:
+    """log() with a caller-supplied timestamp, so a burst of lines (e.g.
+    streamed subprocess output) formats the clock reading once."""
+    # Encode the line once and push the same bytes to both destinations;
+    # skips the text-codec path and the per-call flush of the old handle.
+    b = f"[{_fmt_ts(ts_ns)}] {msg}\n".encode("utf-8")
+    os.write(_STDOUT_FD, b)
+    os.write(_get_log_fd(), b)
+
+
 def log(msg: str) -> None:
-    ART.mkdir(parents=True, exist_ok=True)
-    with LOG.open("a", encoding="utf-8") as f:
-        line = f"[{now()}] {msg}\n"
-        sys.stdout.write(line)
-        sys.stdout.flush()
-        f.write(line)
+    log_at(time.time_ns(), msg)
 
 
-def run(cmd: List[str], timeout: int = 20) -> int:
+def run(cmd: List[str], timeout: int = 20, *, capture: bool = False):
+    """
+    Run a command, streaming its merged stdout/stderr into the log line by
+    line – progress shows live and memory stays at one line instead of the
+    whole buffered output.  Returns the return code, or with capture=True a
+    (returncode, stdout_text) pair so callers that need the output don't
+    have to invoke the command a second time.
+    """
     log(f"$ {' '.join(cmd)} (timeout={timeout}s)")
+    captured: Optional[List[str]] = [] if capture else None
+    p = sp.Popen(cmd, cwd=str(ROOT), text=True, bufsize=1,
+                 stdout=sp.PIPE, stderr=sp.STDOUT)
+
+    def _pump() -> None:
+        # Stamp each line as it arrives: one clock read is noise next to a
+        # pipe readline, and a long-running command's output stays live.
+        for raw in iter(p.stdout.readline, ''):
+            if captured is not None:
+                captured.append(raw)
+            stripped = raw.rstrip()
+            if stripped:
+                log(stripped)
+
+    # Stream from a helper thread so the main thread can enforce the
+    # deadline with wait(); reading inline would block until the child
+    # closed its pipe, letting a silently hung command run forever.
+    reader = threading.Thread(target=_pump, daemon=True)
+    reader.start()
     try:
-        p = sp.run(cmd, cwd=str(ROOT), text=True, timeout=timeout, capture_output=True)
-        if p.stdout:
-            log(p.stdout.rstrip())
-        if p.stderr:
-            log(p.stderr.rstrip())
-        log(f"rc={p.returncode}")
-        return p.returncode
+        rc = p.wait(timeout=timeout)
     except sp.TimeoutExpired:
+        p.kill()
+        p.wait()
+        reader.join()
         log(f"TIMEOUT after {timeout}s")
-        return 124
+        return (124, "".join(captured)) if capture else 124
+    reader.join()
+    log(f"rc={rc}")
+    return (rc, "".join(captured)) if capture else rc
 
 
 class Step:
-    def __init__(self, idx: int, name: str, fn: Callable[[], None], optional: bool = False):
+    # Fixed attribute set: slots drop the per-instance __dict__ and make
+    # attribute access a direct slot load in the scheduler loop.
+    __slots__ = ("idx", "name", "fn", "optional", "deps", "precondition",
+                 "sentinel", "_sentinel_str")
+
+    idx: int
+    name: str
+    fn: Callable[[], None]
+    optional: bool
+    deps: FrozenSet[str]
+    precondition: Optional[Callable[[], bool]]
+    sentinel: Path
+    _sentinel_str: str
+
+    def __init__(self, idx: int, name: str, fn: Callable[[], None], optional: bool = False,
+                 deps: Iterable[str] = (), precondition: Optional[Callable[[], bool]] = None):
         self.idx = idx
         self.name = name
         self.fn = fn
         self.optional = optional
-
-    @property
-    def sentinel(self) -> Path:
-        return LEDGER / f"{self.idx:02d}_{self.name}.ok"
+        # Names of steps that must complete before this one may start;
+        # steps with disjoint deps run concurrently.
+        self.deps = frozenset(deps)
+        # Checked once before fn runs, replacing per-closure guard blocks.
+        self.precondition = precondition
+        # Pre-rendered path string: the resume check is the hottest stat in
+        # the runner and os.path.exists on a str skips Path construction.
+        self._sentinel_str = str(LEDGER / f"{idx:02d}_{name}.ok")
+        self.sentinel = Path(self._sentinel_str)
+
+    def _commit_sentinel(self) -> None:
+        # write tmp → fsync → rename, then fsync the directory: a crash can
+        # never leave a truncated .ok that would falsely SKIP on resume.
+        tmp = self.sentinel.with_suffix(".ok.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, now().encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self.sentinel)
+        dfd = os.open(LEDGER, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
 
     def run(self) -> None:
-        LEDGER.mkdir(parents=True, exist_ok=True)
-        if self.sentinel.exists():
+        # EAFP: one open syscall answers "done already?" instead of a stat
+        # that a concurrent commit could invalidate before we act on it.
+        try:
+            open(self._sentinel_str, "rb").close()
+        except FileNotFoundError:
+            pass
+        else:
             log(f"SKIP step {self.idx:02d}:{self.name} (sentinel exists)")
             return
         log(f"BEGIN step {self.idx:02d}:{self.name}")
         try:
+            if self.precondition is not None and not self.precondition():
+                raise RuntimeError("precondition not met (snowsql missing?)")
             self.fn()
-            self.sentinel.write_text(now())
+            self._commit_sentinel()
             log(f"DONE step {self.idx:02d}:{self.name}")
         except Exception as e:
             log(f"FAIL step {self.idx:02d}:{self.name}: {e}")
             raise
 
 
+def run_steps(steps: List[Step], max_workers: int = 4) -> None:
+    """
+    Dispatch steps as a small DAG: every step whose dependencies are all
+    complete is submitted to the pool, so independent steps (e.g. the two
+    DESCRIBE calls, or table setup vs. probe follow-ups) overlap their
+    network/subprocess latency instead of serializing.
+    """
+    done: set = set()
+    in_flight: dict = {}  # future -> Step
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def launch_ready() -> None:
+            running = {s.name for s in in_flight.values()}
+            for s in steps:
+                if s.name not in done and s.name not in running and s.deps <= done:
+                    in_flight[pool.submit(s.run)] = s
+
+        launch_ready()
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                step = in_flight.pop(fut)
+                fut.result()  # re-raise step failures
+                done.add(step.name)
+            launch_ready()
+    if len(done) != len(steps):
+        missing = [s.name for s in steps if s.name not in done]
+        raise RuntimeError(f"unsatisfiable step dependencies: {missing}")
+
+
 def plan_local() -> List[Step]:
     out_sql = ART / "generated_diff.sql"
+    # Shares s02's SQL text with s03 so the check skips the disk round trip
+    # on a fresh run (resumed runs fall back to reading the file).
+    generated: dict = {}
 
     def s01_pytest():
-        py = (ROOT / "venv" / "bin" / "python").resolve()
-        py_cmd = str(py) if py.exists() else sys.executable
-        rc = run([py_cmd, "-m", "pytest", "-q"])
+        # Fan the suite out across cores when pytest-xdist is installed;
+        # the tests are independent DuckDB sessions so they scale cleanly.
+        cores = os.cpu_count() or 1
+        pytest_args = ["-q"]
+        if cores > 1 and importlib.util.find_spec("xdist") is not None:
+            pytest_args += ["-n", str(cores)]
+        # Run pytest in-process when importable – saves an interpreter
+        # cold start per plan run; shell out only if the import fails.
+        try:
+            import pytest
+        except ImportError:
+            rc = run([PY_CMD, "-m", "pytest"] + pytest_args)
+        else:
+            log(f"pytest {' '.join(pytest_args)} (in-process)")
+            rc = pytest.main(pytest_args + [str(ROOT / "tests")])
         if rc != 0:
             raise RuntimeError(f"pytest failed rc={rc}")
 
     def s02_generate_sql():
-        py = (ROOT / "venv" / "bin" / "python").resolve()
-        py_cmd = str(py) if py.exists() else sys.executable
-        rc = run([
-            py_cmd,
-            "-m",
-            "checkatron.diffgen",
-            "samples/example_before.csv",
-            "samples/example_after.csv",
+        argv = [
+            str(ROOT / "samples/example_before.csv"),
+            str(ROOT / "samples/example_after.csv"),
             "--keys",
-            "samples/example_keys.csv",
+            str(ROOT / "samples/example_keys.csv"),
             "--before_table",
             "before_table",
             "--after_table",
             "after_table",
             "--out",
             str(out_sql),
-        ])
-        if rc != 0:
-            raise RuntimeError(f"sql generation failed rc={rc}")
+        ]
+        try:
+            from checkatron import build_sql, parse_args
+        except ImportError:
+            rc = run([PY_CMD, "-m", "checkatron.diffgen"] + argv)
+            if rc != 0:
+                raise RuntimeError(f"sql generation failed rc={rc}")
+        else:
+            log("generating SQL in-process")
+            sql = build_sql(parse_args(argv))
+            out_sql.write_text(sql)
+            generated["sql"] = sql
         if not out_sql.exists():
             raise RuntimeError("generated SQL missing")
 
     def s03_sanity_check_sql():
-        txt = out_sql.read_text(encoding="utf-8")
+        txt = generated.get("sql")
+        if txt is None:
+            txt = out_sql.read_text(encoding="utf-8")
         must = [
             "CREATE OR REPLACE TABLE",
             "diff_result",
             "WITH\n",
         ]
-        for m in must:
-            if m not in txt:
-                raise RuntimeError(f"expected token not found in sql: {m}")
+        # One linear scan over the SQL instead of one 'in' pass per token
+        pattern = re.compile("|".join(re.escape(m) for m in must))
+        found = {m.group(0) for m in pattern.finditer(txt)}
+        missing = [m for m in must if m not in found]
+        if missing:
+            raise RuntimeError(f"expected tokens not found in sql: {missing}")
 
     return [
         Step(1, "pytest", s01_pytest),
         Step(2, "generate_sql", s02_generate_sql),
-        Step(3, "sanity_check_sql", s03_sanity_check_sql),
+        Step(3, "sanity_check_sql", s03_sanity_check_sql, deps={"generate_sql"}),
     ]
 
 
+@functools.lru_cache(maxsize=1)
 def _snowsql() -> Optional[str]:
     return shutil.which("snowsql")
 
 
+def _have_snowsql() -> bool:
+    return _snowsql() is not None
+
+
 def plan_snowflake() -> List[Step]:
     exe = _snowsql()
     profile = os.environ.get("SNOWSQL_PROFILE")
+    # argv prefix shared by every snowsql invocation, profile baked in once
+    snowsql_prefix: List[str] = [exe or "snowsql"] + (["-c", profile] if profile else [])
     out_sql = ART / "generated_diff.sql"
 
     def s01_probe():
@@ -153,28 +328,25 @@ def plan_snowflake() -> List[Step]:
         if rc != 0:
             raise RuntimeError("probe reported nonzero rc")
 
-    def s02_setup_tables():
-        if not exe:
-            raise RuntimeError("snowsql missing")
-        # Use TEMP tables; safe to rerun with CREATE OR REPLACE
+    def _run_snowsql_script(sql: str, timeout: int = 60) -> None:
+        # One snowsql -f session amortizes the auth/connect handshake
+        # across every statement in the script.
+        tmp = ART / f"tmp_{uuid.uuid4().hex}.sql"
+        tmp.write_text(sql, encoding="utf-8")
+        rc = run([*snowsql_prefix, "-f", str(tmp)], timeout=timeout)
+        if rc != 0:
+            raise RuntimeError(f"snowsql script failed rc={rc}")
+        tmp.unlink()
+
+    def s02_bootstrap():
+        # Use TEMP tables; safe to rerun with CREATE OR REPLACE.  Setup and
+        # load run in one session – mandatory for TEMP tables, which are
+        # session-scoped, and it saves a full connect per statement batch.
         sql = (
             "CREATE OR REPLACE TEMPORARY TABLE before_table("
             "ACCOUNT_ID NUMBER, PORTFOLIO_NAME VARCHAR(50), VALUATION_DATE DATE, BALANCE NUMBER(15,2), STATUS VARCHAR(20));"
             "CREATE OR REPLACE TEMPORARY TABLE after_table("
             "ACCOUNT_ID NUMBER, PORTFOLIO_NAME VARCHAR(50), VALUATION_DATE DATE, BALANCE NUMBER(15,2), STATUS VARCHAR(20), NEW_COLUMN NUMBER(10,2));"
-        )
-        cmd = [exe]
-        if profile:
-            cmd += ["-c", profile]
-        cmd += ["-q", sql]
-        rc = run(cmd, timeout=20)
-        if rc != 0:
-            raise RuntimeError("table setup failed")
-
-    def s03_load_data():
-        if not exe:
-            raise RuntimeError("snowsql missing")
-        sql = (
             "INSERT INTO before_table VALUES"
             " (1001,'PORTFOLIO_A','2024-01-01',10000.00,'ACTIVE'),"
             " (1002,'PORTFOLIO_B','2024-01-01',25000.50,'ACTIVE'),"
@@ -189,36 +361,24 @@ def plan_snowflake() -> List[Step]:
             " (1005,'PORTFOLIO_B','2024-01-01',35000.00,'ACTIVE',400.00),"
             " (1006,'PORTFOLIO_D','2024-01-01',7500.00,'ACTIVE',500.00);"
         )
-        cmd = [exe]
-        if profile:
-            cmd += ["-c", profile]
-        cmd += ["-q", sql]
-        rc = run(cmd, timeout=30)
-        if rc != 0:
-            raise RuntimeError("data load failed")
+        _run_snowsql_script(sql, timeout=45)
 
-    def s04_describe_to_csv():
-        if not exe:
-            raise RuntimeError("snowsql missing")
-        before = ROOT / "samples/example_before.csv"
-        after = ROOT / "samples/example_after.csv"
+    def _describe_to_csv(table: str, dest: Path):
         # Use output_file option to write csv
         base = ["-o", "output_format=csv", "-o", "header=true"]
-        cmd1 = [exe] + (["-c", profile] if profile else []) + base + ["-q", "DESCRIBE TABLE before_table"]
-        cmd2 = [exe] + (["-c", profile] if profile else []) + base + ["-q", "DESCRIBE TABLE after_table"]
+        cmd = [*snowsql_prefix, *base, "-q", f"DESCRIBE TABLE {table}"]
         # We can't direct output_file per command in all versions; as fallback, redirect stdout via shell is avoided here.
-        # Instead, capture stdout and write files locally.
-        rc = run(cmd1, timeout=20)
-        if rc != 0:
-            raise RuntimeError("describe before failed")
-        # The run() already logged stdout; re‑run to capture programmatically
-        p = sp.run(cmd1, cwd=str(ROOT), text=True, capture_output=True)
-        before.write_text(p.stdout)
-        rc = run(cmd2, timeout=20)
+        # Instead, capture stdout from the single invocation and write it locally.
+        rc, out = run(cmd, timeout=20, capture=True)
         if rc != 0:
-            raise RuntimeError("describe after failed")
-        p = sp.run(cmd2, cwd=str(ROOT), text=True, capture_output=True)
-        after.write_text(p.stdout)
+            raise RuntimeError(f"describe {table} failed")
+        dest.write_text(out)
+
+    def s04a_describe_before():
+        _describe_to_csv("before_table", ROOT / "samples/example_before.csv")
+
+    def s04b_describe_after():
+        _describe_to_csv("after_table", ROOT / "samples/example_after.csv")
 
     def s05_generate_sql():
         rc = run([
@@ -240,16 +400,12 @@ def plan_snowflake() -> List[Step]:
             raise RuntimeError("sql generation failed")
 
     def s06_execute_sql():
-        if not exe:
-            raise RuntimeError("snowsql missing")
-        cmd = [exe] + (["-c", profile] if profile else []) + ["-f", str(out_sql)]
+        cmd = [*snowsql_prefix, "-f", str(out_sql)]
         rc = run(cmd, timeout=60)
         if rc != 0:
             raise RuntimeError("executing generated sql failed")
 
     def s07_validate_queries():
-        if not exe:
-            raise RuntimeError("snowsql missing")
         sql = (
             "SELECT COUNT(*) total_rows,"
             " SUM(CASE WHEN _row_status = 0 THEN 1 ELSE 0 END) matching_rows,"
@@ -258,19 +414,27 @@ def plan_snowflake() -> List[Step]:
             " SUM(CASE WHEN _row_status = 5 THEN 1 ELSE 0 END) missing_in_after"
             " FROM diff_result;"
         )
-        cmd = [exe] + (["-c", profile] if profile else []) + ["-o", "output_format=csv", "-q", sql]
+        cmd = [*snowsql_prefix, "-o", "output_format=csv", "-q", sql]
         rc = run(cmd, timeout=30)
         if rc != 0:
             raise RuntimeError("validation query failed")
 
+    # The two DESCRIBEs are independent of each other and of load_data,
+    # so they overlap once setup_tables has created the tables.
     return [
         Step(1, "probe", s01_probe),
-        Step(2, "setup_tables", s02_setup_tables, optional=True),
-        Step(3, "load_data", s03_load_data, optional=True),
-        Step(4, "describe_to_csv", s04_describe_to_csv, optional=True),
-        Step(5, "generate_sql", s05_generate_sql),
-        Step(6, "execute_sql", s06_execute_sql, optional=True),
-        Step(7, "validate_queries", s07_validate_queries, optional=True),
+        Step(2, "bootstrap", s02_bootstrap, optional=True,
+             deps={"probe"}, precondition=_have_snowsql),
+        Step(3, "describe_before", s04a_describe_before, optional=True,
+             deps={"bootstrap"}, precondition=_have_snowsql),
+        Step(4, "describe_after", s04b_describe_after, optional=True,
+             deps={"bootstrap"}, precondition=_have_snowsql),
+        Step(5, "generate_sql", s05_generate_sql,
+             deps={"describe_before", "describe_after"}),
+        Step(6, "execute_sql", s06_execute_sql, optional=True,
+             deps={"generate_sql", "bootstrap"}, precondition=_have_snowsql),
+        Step(7, "validate_queries", s07_validate_queries, optional=True,
+             deps={"execute_sql"}, precondition=_have_snowsql),
     ]
 
 
@@ -278,18 +442,34 @@ def archive_ledger() -> None:
     if not LEDGER.exists():
         log("No ledger to archive")
         return
-    ts = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+    # Epoch seconds plus pid: cheaper than strftime and two --reset runs in
+    # the same second can no longer collide on the backup name.
+    ts = f"{int(time.time())}.{os.getpid()}"
     dest = ART / f"ledger.{ts}.bak"
-    shutil.move(str(LEDGER), str(dest))
+    try:
+        # Same directory, so a single rename syscall does it; no need for
+        # shutil.move's copy-then-delete machinery.
+        os.rename(LEDGER, dest)
+    except OSError:
+        # EXDEV etc. – fall back to the copying move.
+        shutil.move(str(LEDGER), str(dest))
     log(f"Archived ledger to {dest}")
 
 
 def main(argv: List[str]) -> int:
-    # Prefer project venv interpreter if present to ensure deps (duckdb, pytest) are available
-    vpy = ROOT / "venv" / "bin" / "python"
-    if vpy.exists() and Path(sys.executable).resolve() != vpy.resolve():
-        # Re‑exec under venv python
-        os.execv(str(vpy), [str(vpy), __file__] + argv)
+    # Prefer project venv interpreter if present to ensure deps (duckdb, pytest) are available.
+    # Compare device+inode rather than resolved paths: one stat each instead
+    # of a symlink walk, and correct across bind mounts.
+    if VENV_PY is not None:
+        try:
+            a = os.stat(sys.executable)
+            b = os.stat(VENV_PY)
+            same = (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+        except FileNotFoundError:
+            same = False
+        if not same:
+            # Re‑exec under venv python
+            os.execv(str(VENV_PY), [str(VENV_PY), __file__] + argv)
 
     ap = argparse.ArgumentParser(description="Step ledger runner")
     ap.add_argument("--plan", choices=["local", "snowflake"], default="local")
@@ -299,14 +479,20 @@ def main(argv: List[str]) -> int:
     ART.mkdir(parents=True, exist_ok=True)
     LOG.touch(exist_ok=True)
 
+    # Recovery: drop sentinel commits aborted by a crash mid-write
+    for tmp in LEDGER.glob("*.ok.tmp"):
+        tmp.unlink()
+
     if args.reset:
         archive_ledger()
         return 0
 
+    # Created once here rather than at the top of every Step.run.
+    LEDGER.mkdir(parents=True, exist_ok=True)
+
     steps = plan_local() if args.plan == "local" else plan_snowflake()
     log(f"Running plan: {args.plan}")
-    for step in steps:
-        step.run()
+    run_steps(steps)
     log("All steps complete")
     return 0
 